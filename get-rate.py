@@ -1,10 +1,11 @@
 #!/usr/bin/python3
 
 import pydbus
-import time
+import struct
+import sys
 import logging
-from logging import warning, info, debug
-from gi.repository import GLib
+from logging import info, debug
+from gi.repository import GLib, Gio
 
 class DeviceNotFound (Exception): pass
 class DeviceConnexionError (Exception): pass
@@ -14,20 +15,116 @@ class DeviceConnexionError (Exception): pass
 HRM_service_uuid = "0000180d-0000-1000-8000-00805f9b34fb"
 HRM_characteristic_uuid = "00002a37-0000-1000-8000-00805f9b34fb"
 
+# bluez reports UUIDs in lowercase : fold ours once at import so the
+# object-tree scans compare strings directly
+HRM_SERVICE_UUID_CF = HRM_service_uuid.casefold()
+HRM_CHARACTERISTIC_UUID_CF = HRM_characteristic_uuid.casefold()
+
+# RR intervals come in 1/1024 s units, convert to beats per minute
+_RR_SCALE = 60 * 1024
+
+# coalescing window for notification bursts (milliseconds)
+_COALESCE_MS = 250
+
+# static description of the only remote interface we drive directly,
+# parsed once at import so no Introspect round-trip is needed at runtime
+GATT_CHAR_XML = """
+<node>
+  <interface name='org.bluez.GattCharacteristic1'>
+    <method name='StartNotify'/>
+    <method name='StopNotify'/>
+    <property name='UUID' type='s' access='read'/>
+    <property name='Value' type='ay' access='read'/>
+  </interface>
+</node>
+"""
+
 # DBus object paths
 BLUEZ_SERVICE = 'org.bluez'
 ADAPTER_PATH = '/org/bluez/hci0'
 #DEVICE_PATH = f"{ADAPTER_PATH}/dev_{DEVICE_ADDR.replace(':', '_')}"
 
-def as_uint( bytelist ):
-    val=0
-    for i in range( len(bytelist) ):
-        val += bytelist[i] * pow( 256 , i )
-    return val
+# Optional numba-compiled decode path. The notification loop runs
+# indefinitely on possibly battery-powered hosts, so spend the one-off
+# compilation cost when numba is available and fall back to the pure
+# python decoder otherwise.
+try:
+    import numpy as np
+    from numba import njit
+
+    @njit( cache=True )
+    def _decode_jit( buf ):
+        # external BLE data and no bounds checking in njit code : guard
+        # every read, hr = -1 signals a truncated frame
+        bad = -1, -1, np.empty( 0, dtype=np.float64 )
+        if( buf.size < 2 ):
+            return bad
+        flags = buf[0]
+        if( flags & 0x01 ):
+            if( buf.size < 3 ):
+                return bad
+            hr = buf[1] | ( buf[2] << 8 )
+            off = 3
+        else:
+            hr = buf[1]
+            off = 2
+        ee = -1
+        if( flags & 0x08 ):
+            if( buf.size < off + 2 ):
+                return bad
+            ee = buf[off] | ( buf[off+1] << 8 )
+            off += 2
+        n_rr = ( buf.size - off ) // 2
+        rr = np.empty( n_rr, dtype=np.float64 )
+        for i in range( n_rr ):
+            rr[i] = _RR_SCALE / ( buf[off] | ( buf[off+1] << 8 ) )
+            off += 2
+        return hr, ee, rr
+
+    def _decode_numba( buf ):
+        hr, ee, rr = _decode_jit( np.frombuffer( buf, dtype=np.uint8 ) )
+        if( hr < 0 ):
+            raise ValueError( "truncated HR frame" )
+        return hr, ( None if ee < 0 else ee ), rr.tolist()
+
+except ImportError:
+    _decode_numba = None
+
+# Optional native decoder built by parse_hr.py (cffi). Preferred over the
+# numba path when present : one FFI call per frame, no JIT warmup.
+try:
+    from parse_hr_c import ffi as _ffi, lib as _parse_hr_lib
+
+    def _decode_c( buf ):
+        out = _ffi.new( "hr_frame_t *" )
+        if( _parse_hr_lib.parse_hr_frame( _ffi.from_buffer(buf), len(buf), out ) != 0 ):
+            raise ValueError( "truncated HR frame" )
+        rr = [ _RR_SCALE / out.rr_ticks[i] for i in range( out.rr_count ) ]
+        return out.hr, ( None if out.ee < 0 else out.ee ), rr
+
+except ImportError:
+    _decode_c = None
+
+_GATT_CHAR_INFO = Gio.DBusNodeInfo.new_for_xml( GATT_CHAR_XML ).interfaces[0]
+
+# variant type of the characteristic 'Value' property
+_VARIANT_AY = GLib.VariantType( 'ay' )
+
+# bound method for measurement output, skips the sys.stdout attribute
+# lookups and argument handling print() does on every frame
+_write = sys.stdout.write
+
+def private_system_bus():
+    """Open a private connection to the system bus.
+    One-shot setup traffic (managed-objects fetch, discovery) goes through
+    it so the long-lived notification connection never accumulates the
+    match rules and broadcast traffic of the setup phase"""
+    addr = Gio.dbus_address_get_for_bus_sync( Gio.BusType.SYSTEM, None )
+    return pydbus.connect( addr )
 
 def generic_signal_handler(*args, **kwargs):
     for i, arg in enumerate(args):
-        debug("arg:%d        %s" % (i, str(arg)))
+        debug("arg:%d        %s", i, arg)
     debug('kwargs:')
     debug(kwargs)
     debug('---end----')
@@ -35,80 +132,192 @@ def generic_signal_handler(*args, **kwargs):
 class HR_measurement():
     """ decode a 0x2a37 heart rate measurement frame
     https://www.bluetooth.com/specifications/specs/heart-rate-service-1-0/"""
+    __slots__ = ( 'HR', 'EE', 'RR' )
+
     def __init__( self, data ):
+        # pydbus hands us a list of ints : convert once so the decoders can
+        # read in place. Bytes-like input (bytes, bytearray, memoryview) is
+        # used as-is, zero copies
+        if( isinstance( data, (bytes, bytearray, memoryview) ) ):
+            buf = data
+        else:
+            buf = bytes( data )
+
+        if( _decode_c is not None ):
+            self.HR, self.EE, self.RR = _decode_c( buf )
+            return
+        if( _decode_numba is not None ):
+            self.HR, self.EE, self.RR = _decode_numba( buf )
+            return
+
         # extract flags field
-        flags = data[0]
-        data = data [1:]
+        flags = buf[0]
+        off = 1
 
         # is hr expressed as UINT8 or UINT16 ?
-        if (flags & 0x01): 
-            self.HR = as_uint( data[0:2] )
-            data=data[2:]
+        if (flags & 0x01):
+            self.HR, = struct.unpack_from( '<H', buf, off )
+            off += 2
         else:
-            self.HR = as_uint( data[0:1] )
-            data=data[1:]
-        
+            self.HR = buf[off]
+            off += 1
+
         # calories
         if( flags & 0x08 ):
-            self.EE = as_uint( data[0:2] )
-            data=data[2:]
+            self.EE, = struct.unpack_from( '<H', buf, off )
+            off += 2
         else:
             self.EE = None
 
         # RR-interval (peak-to-peak time)
-        self.RR = []
-        while( len(data) ):
-            rr = 60 * 1024 / as_uint( data[0:2] )
-            data=data[2:]
-            self.RR.append( rr ) 
+        n_rr = ( len(buf) - off ) // 2
+        self.RR = [ _RR_SCALE / x for x in struct.unpack_from( '<%dH' % n_rr, buf, off ) ]
 
     def __repr__(self):
-        ret = [ "%d bpm" % self.HR ]
         if( self.EE ):
-            ret.append( "%d Joules" % self.EE )
-        ret.append ( "RR %s" % str(self.RR) )
-        return " / ".join(ret)
+            return f"{self.HR} bpm / {self.EE} Joules / RR {self.RR}"
+        return f"{self.HR} bpm / RR {self.RR}"
 
 class HeartRateLoop():
     def __init__(self ):
         # setup dbus
         self.bus     = pydbus.SystemBus()
-        self.mngr    = self.bus.get( BLUEZ_SERVICE, '/')
-        self.adapter = self.bus.get( BLUEZ_SERVICE, ADAPTER_PATH ) 
+        # bluez proxies for the setup phase live on a private bus, see start()
+        self.setup_bus = None
+        self.mngr    = None
+        self.adapter = None
+        self.objs    = None
+        # coalescing state for notification bursts
+        self._latest   = None
+        self._flush_id = None
+
+    def managed_objects( self, refresh=False ):
+        """Cached copy of the whole BlueZ object tree.
+        GetManagedObjects marshals every object over the bus, so fetch it
+        once and refresh only when the tree may have changed (discovery,
+        service resolution)"""
+        if( refresh or self.objs is None ):
+            self.objs = self.mngr.GetManagedObjects()
+        return self.objs
 
 
     def get_device( self, uuid, retry, discovery_delay ):
         """ Get HR sensor device as a dbus proxy object 
         retry = -1 for infinite discovery"""
 
-        try:
-            path = self.get_device_path( uuid )
+        while True:
+            try:
+                path = self.get_device_path( uuid, self.managed_objects() )
+            except (AttributeError, KeyError) :
+                path = None
+
+            if( path is None and retry != 0 ):
+                retry = max( -1, retry-1 )
+                path = self.wait_device_added( uuid, discovery_delay )
+                if( path is None ):
+                    # a known device may just have started advertising : it
+                    # gets PropertiesChanged, not InterfacesAdded, so rescan
+                    self.managed_objects( refresh=True )
+                    continue
+
             if( path ):
-                dev = self.bus.get( BLUEZ_SERVICE, path )
-            else:
-                dev = None
-        except (AttributeError, KeyError) :
-            if (retry == 0 ):
-                raise DeviceNotFound( "No device found with service UUID %s " % uuid )
-
-        if( dev ):
-            info("Device found : %s" % path)
-            self.device_path = path
-            return dev 
-        else :
-            debug( "Starting bluetooth discovery for %d seconds" % discovery_delay )
-            self.adapter.StartDiscovery()
-            time.sleep(discovery_delay)
-            self.adapter.StopDiscovery()
-            debug( "Stopped discovery")
-            return self.get_device( uuid, max( -1, retry-1) , discovery_delay )
+                info("Device found : %s", path)
+                self.device_path = path
+                return self.bus.get( BLUEZ_SERVICE, path )
+
+            raise DeviceNotFound( "No device found with service UUID %s " % uuid )
+
+    def wait_device_added( self, uuid, timeout ):
+        """Run discovery until InterfacesAdded announces a device with the
+        service UUID, at most timeout seconds. Event-driven : returns as
+        soon as the sensor is seen instead of always sleeping the full
+        delay, and without refetching the whole object tree.
+        uuid must already be casefolded"""
+        found = []
+        timed_out = []
+        loop = GLib.MainLoop()
+
+        def on_timeout():
+            timed_out.append( True )
+            loop.quit()
+            return GLib.SOURCE_REMOVE
+
+        def on_interfaces_added( conn, sender, path, iface, signal, params ):
+            obj_path, ifaces = params.unpack()
+            dev = ifaces.get('org.bluez.Device1')
+            if( dev and uuid in dev.get('UUIDs', ()) ):
+                found.append( obj_path )
+                loop.quit()
+
+        debug( "Starting bluetooth discovery for up to %d seconds", timeout )
+        con = self.setup_bus.con
+        sub_id = con.signal_subscribe(
+            BLUEZ_SERVICE,
+            'org.freedesktop.DBus.ObjectManager',
+            'InterfacesAdded',
+            '/',
+            None,
+            0,
+            on_interfaces_added )
+        timeout_id = GLib.timeout_add_seconds( timeout, on_timeout )
+        self.adapter.StartDiscovery()
+        loop.run()
+        self.adapter.StopDiscovery()
+        con.signal_unsubscribe( sub_id )
+        debug( "Stopped discovery")
+        # the source is gone already if the timeout fired
+        if( not timed_out ):
+            GLib.source_remove( timeout_id )
+        if( found ):
+            return found[0]
+        return None
+
+    def wait_services_resolved( self, timeout ):
+        """Wait for bluez to finish service resolution on the device.
+        Event-driven : returns on the PropertiesChanged that flips
+        ServicesResolved instead of polling the property over the bus.
+        Raises DeviceConnexionError after timeout seconds"""
+        loop = GLib.MainLoop()
+
+        def on_props_changed( conn, sender, path, iface, signal, params ):
+            v = params.get_child_value(1).lookup_value( 'ServicesResolved', None )
+            if( v is not None and v.get_boolean() ):
+                loop.quit()
+
+        con = self.setup_bus.con
+        sub_id = con.signal_subscribe(
+            BLUEZ_SERVICE,
+            'org.freedesktop.DBus.Properties',
+            'PropertiesChanged',
+            self.device_path,
+            'org.bluez.Device1',    # arg0 match
+            0,
+            on_props_changed )
+        # subscribe first, then check : resolution may already be over
+        if( not self.device.ServicesResolved ):
+            timed_out = []
+
+            def on_timeout():
+                timed_out.append( True )
+                loop.quit()
+                return GLib.SOURCE_REMOVE
+
+            timeout_id = GLib.timeout_add_seconds( timeout, on_timeout )
+            loop.run()
+            # the source is gone already if the timeout fired
+            if( not timed_out ):
+                GLib.source_remove( timeout_id )
+            if( not self.device.ServicesResolved ):
+                con.signal_unsubscribe( sub_id )
+                raise DeviceConnexionError( "Services not resolved on %s after %d seconds" % (self.device_path, timeout) )
+        con.signal_unsubscribe( sub_id )
 
     def connect_device( self, retry ):
         while( not self.device.Connected ):
             try:
                 retry -= 1
                 self.device.Connect()
-                debug( "Connected to %s" % self.device.Name)
+                debug( "Connected to %s", self.device.Name)
             except Exception as e:
                 debug( str(e) )
                 if( retry > 0):
@@ -118,57 +327,105 @@ class HeartRateLoop():
                 else :
                     raise DeviceConnexionError( "Erreur de connexion à %s" % self.device.Name)
 
-    def get_device_path( self, uuid ):
-        """Look up DBus path for device with UUID in its announced services"""
-        objs = self.mngr.GetManagedObjects()
-        for path in objs:
-            srv_uuids = objs[path].get('org.bluez.Device1', {}).get('UUIDs')
-            if( srv_uuids and uuid.casefold() in srv_uuids ):
+    def get_device_path( self, uuid, objs ):
+        """Look up DBus path for device with UUID in its announced services.
+        uuid must already be casefolded"""
+        for path, ifaces in objs.items():
+            dev = ifaces.get('org.bluez.Device1')
+            if( dev is None ):
+                continue
+            srv_uuids = dev.get('UUIDs')
+            if( srv_uuids and uuid in srv_uuids ):
                 return path
 
 
-    def get_characteristic_path( self, uuid ):
-        """Look up DBus path for characteristic UUID"""
-        objs = self.mngr.GetManagedObjects()
-        for path in objs:
-            chr_uuid = objs[path].get('org.bluez.GattCharacteristic1', {}).get('UUID')
-            if path.startswith(self.device_path) and chr_uuid == uuid.casefold():
+    def get_characteristic_path( self, uuid, objs ):
+        """Look up DBus path for characteristic UUID.
+        uuid must already be casefolded"""
+        for path, ifaces in objs.items():
+            chrc = ifaces.get('org.bluez.GattCharacteristic1')
+            if( chrc is None ):
+                continue
+            if path.startswith(self.device_path) and chrc.get('UUID') == uuid:
                 return path
 
-    @classmethod
-    def notification_handler( cls, interface_name, changed_props, invalidated_props) :
-        if( not interface_name == "org.bluez.GattCharacteristic1" ):
-            warn( "Unexpected signal from %s interface" % interface_name)
-        try:
-            data = changed_props['Value']
-            hrm = HR_measurement(data)
-            print( hrm )
-        except KeyError:
+    def notification_handler( self, conn, sender, path, iface, signal, params ):
+        """Low-level Gio signal callback, params is a (sa{sv}as) variant"""
+        # pull only 'Value' out of the changed dict : the other entries are
+        # never converted to python objects at all
+        value = params.get_child_value(1).lookup_value( 'Value', _VARIANT_AY )
+        if( value is None ):
             debug ("Ignored signal without 'Value' property")
+            return
+        data = value.get_data_as_bytes().get_data()
+        # sensors may fire several PropertiesChanged per heartbeat : keep
+        # only the latest frame and decode once per coalescing window
+        self._latest = data
+        if( self._flush_id is None ):
+            self._flush_id = GLib.timeout_add( _COALESCE_MS, self._flush )
+
+    def _flush( self ):
+        self._flush_id = None
+        hrm = HR_measurement( self._latest )
+        _write( repr(hrm) + "\n" )
+        return False
 
 
     def start( self ):
-        self.device = self.get_device( uuid = HRM_service_uuid, retry = 2, discovery_delay = 5 )         
+        self.setup_bus = private_system_bus()
+        self.mngr    = self.setup_bus.get( BLUEZ_SERVICE, '/')
+        self.adapter = self.setup_bus.get( BLUEZ_SERVICE, ADAPTER_PATH )
+
+        self.device = self.get_device( uuid = HRM_SERVICE_UUID_CF, retry = 2, discovery_delay = 5 )
         self.connect_device(retry=2)
 
         # TODO : handle connection failure
-        # TODO : add a timeout on ServicesResolved
-        while not self.device.ServicesResolved and self.device.Connected :
-            time.sleep(0.5)
+        self.wait_services_resolved( timeout=20 )
 
-        hrm_path = self.get_characteristic_path( uuid=HRM_characteristic_uuid)
+        # GATT characteristic objects only appear once services are resolved
+        hrm_path = self.get_characteristic_path( HRM_CHARACTERISTIC_UUID_CF,
+                                                 self.managed_objects( refresh=True ) )
         # TODO : handle when hrm characteristic is not found
 
-        hrm = self.bus.get( BLUEZ_SERVICE, hrm_path )
-        hrm.StartNotify()
-        with hrm.PropertiesChanged.connect( self.notification_handler ):
-            loop = GLib.MainLoop()
-            try :
-                loop.run()
-            except KeyboardInterrupt:
-                loop.quit()
-                hrm.StopNotify()
-                self.device.Disconnect()
+        # setup is over, release the private connection
+        self.mngr    = None
+        self.adapter = None
+        self.objs    = None
+        self.setup_bus.con.close_sync( None )
+        self.setup_bus = None
+
+        # build the characteristic proxy from the static interface info :
+        # no Introspect call, no property fetch, no implicit signal match
+        hrm = Gio.DBusProxy.new_sync(
+            self.bus.con,
+            Gio.DBusProxyFlags.DO_NOT_LOAD_PROPERTIES |
+            Gio.DBusProxyFlags.DO_NOT_CONNECT_SIGNALS,
+            _GATT_CHAR_INFO,
+            BLUEZ_SERVICE,
+            hrm_path,
+            'org.bluez.GattCharacteristic1',
+            None )
+
+        # subscribe at the Gio level so dbus-daemon only delivers
+        # PropertiesChanged for this object, and do it *before* StartNotify
+        # so the first (possibly cached) notification is not missed
+        sub_id = self.bus.con.signal_subscribe(
+            BLUEZ_SERVICE,
+            'org.freedesktop.DBus.Properties',
+            'PropertiesChanged',
+            hrm_path,
+            'org.bluez.GattCharacteristic1',   # arg0 match, drops others in the daemon
+            0,
+            self.notification_handler )
+        hrm.call_sync( 'StartNotify', None, Gio.DBusCallFlags.NONE, -1, None )
+        loop = GLib.MainLoop()
+        try :
+            loop.run()
+        except KeyboardInterrupt:
+            loop.quit()
+            self.bus.con.signal_unsubscribe( sub_id )
+            hrm.call_sync( 'StopNotify', None, Gio.DBusCallFlags.NONE, -1, None )
+            self.device.Disconnect()
 
 logging.basicConfig(format='%(levelname)s:%(message)s', level=logging.DEBUG)
 l=HeartRateLoop()